@@ -6,6 +6,7 @@ from django.db import models
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.functional import cached_property
 from mptt.models import MPTTModel, TreeForeignKey
 
 
@@ -48,8 +49,25 @@ class Comment (MPTTModel):
     deleted = models.BooleanField(default=False)
     """ deleted flag if the comment was deleted by the user """
     
+    current_version = models.ForeignKey('CommentVersion', on_delete=models.SET_NULL, related_name='+', null=True, blank=True, editable=False)
+    """ The most recent version saved through new_version (views), used to reject edits of an older version. Versions created any other way leave it stale, new_version repairs it on the next edit. """
+    
+    class Meta:
+        indexes = [
+            # load_comments reads a tree's comments that aren't deleted in (tree_id, lft) order, this partial index covers exactly that (and skips the deleted rows entirely)
+            models.Index(fields=['tree_id', 'lft'], name='comment_live_idx', condition=models.Q(deleted=False)),
+        ]
+    
     class MPTTMeta:
         order_insertion_by  = 'date_created'
+
+    @cached_property
+    def latest_version(self):
+        """ The most recent CommentVersion of this comment (None if there isn't one yet). load_comments and new_version assign it directly, so they don't cost a query. """
+        try:
+            return self.versions.latest()
+        except CommentVersion.DoesNotExist:
+            return None
     
 class CommentVersion (models.Model):
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='versions')
@@ -0,0 +1,52 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _json_dumps(value):
+    """
+    Encodes 'value' as JSON, with orjson when it's installed. Anything orjson can't encode natively (ex. Decimal, lazy translations) goes through DjangoJSONEncoder, same as JsonResponse.
+    """
+    if orjson:
+        return orjson.dumps(value, default=DjangoJSONEncoder().default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+class OrjsonResponse(HttpResponse):
+    """
+    A drop in replacement for JsonResponse that encodes with orjson (when it's installed).
+    """
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=_json_dumps(data), **kwargs)
+
+class StreamingJsonResponse(StreamingHttpResponse):
+    """
+    A JSON response that encodes its (large) string values a chunk at a time as it is sent, instead of building the whole encoded document in memory first.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(self._encode(data), **kwargs)
+
+    def _encode(self, data):
+        yield b'{'
+        for index, (key, value) in enumerate(data.items()):
+            if index:
+                yield b','
+            yield _json_dumps(str(key))
+            yield b':'
+            if isinstance(value, str) and len(value) > self.chunk_size:
+                # Each slice is encoded on its own and its quotes are stripped, so the chunks join up into one JSON string
+                yield b'"'
+                for start in range(0, len(value), self.chunk_size):
+                    yield _json_dumps(value[start:start + self.chunk_size])[1:-1]
+                yield b'"'
+            else:
+                yield _json_dumps(value)
+        yield b'}'
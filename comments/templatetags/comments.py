@@ -1,10 +1,8 @@
 from django import template
 from django.contrib.contenttypes.models import ContentType
 from django.urls import reverse
-from django.template import loader
-from django.template.loader import render_to_string
 
-from ..utils import user_has_permission, get_attr_val
+from ..utils import user_has_permission, get_attr_val, _get_compiled_template
 
 import json
 
@@ -58,11 +56,9 @@ def render_comments(parent_item, **kwargs):
         'ct_id': ContentType.objects.get_for_model(parent_item).id,
         'obj_id': parent_item.id,
     }
-    return loader.render_to_string(initialize_template, context)
+    return _get_compiled_template(initialize_template).render(context)
 
 @register.simple_tag(takes_context=True)
 def get_latest_version(context):
-    # Since the versions were already ordered in the prefetch we just get the first one
-    if context['node'].versions.count():
-        return context['node'].versions.all()[0]
-    return None
+    # When the tree was loaded by load_comments this was already pulled from the (ordered) versions prefetch
+    return context['node'].latest_version
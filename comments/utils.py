@@ -1,9 +1,26 @@
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
 from django.db import models
+from django.db.models import OuterRef, Subquery
+from django.dispatch import receiver
+from django.template import loader
 from .models import Comment, CommentVersion
 
+from functools import lru_cache
+import hashlib
 import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# What an empty/missing 'X_KWARGS' header is parsed as
+_EMPTY_KWARGS_JSON = '{}'
 
 class InvalidCommentException(Exception):
     """
@@ -20,7 +37,12 @@ def _get_target_comment(request):
     # Check if the user is attempting to edit an existing comment...
     if 'version_id' in request.POST:
         try:
-            previous_version = CommentVersion.objects.select_related('comment').get(id=request.POST.get('version_id'))
+            # The parent is fetched in the same query since every caller needs it to find the tree root, and so is the id of the comment's latest version
+            # (as 'latest_version_id') so an edit of an older version can be turned away without another round trip
+            latest_version_id = Subquery(CommentVersion.objects.filter(comment=OuterRef('comment')).order_by('-date_posted').values('pk')[:1])
+            previous_version = CommentVersion.objects.select_related('comment', 'comment__parent')\
+                                                     .annotate(latest_version_id=latest_version_id)\
+                                                     .get(id=request.POST.get('version_id'))
             return previous_version.comment, previous_version
         except CommentVersion.DoesNotExist:
             raise InvalidCommentException("The comment you are attempting to update could not be found.")
@@ -69,6 +91,35 @@ def _get_or_create_tree_root(request):
     else:
         raise InvalidCommentException("Unable to access comment tree: invalid request parameters.")
     
+def get_cached_root(comment):
+    """
+    Returns the root of the comment's tree, only querying for it the first time it's asked for on a given comment instance.
+    """
+    if '_cached_root' not in comment.__dict__:
+        comment._cached_root = comment.get_root()
+    return comment._cached_root
+
+def _request_kwargs(request):
+    """
+    Returns the kwargs passed back in the 'X_KWARGS' header (populated by settings.kwarg in comments.js).
+    The header is only parsed once per request (with orjson when it's installed). Each call gets its own copy, since the views add to it.
+    """
+    if not hasattr(request, '_comment_kwargs'):
+        header = request.META.get('HTTP_X_KWARGS') or _EMPTY_KWARGS_JSON
+        request._comment_kwargs = orjson.loads(header) if orjson else json.loads(header)
+    return dict(request._comment_kwargs)
+
+def _get_parent_object(request, tree_root):
+    """
+    Returns the object a comment tree is attached to (the tree_root's content_object).
+    These are cached on the request by content type and object id, so each one is only fetched once no matter how many times (or through which root instance) it's asked for.
+    """
+    parent_object_cache = request.__dict__.setdefault('_comment_parent_object_cache', {})
+    cache_key = (tree_root.content_type_id, tree_root.object_id)
+    if cache_key not in parent_object_cache:
+        parent_object_cache[cache_key] = tree_root.content_object
+    return parent_object_cache[cache_key]
+
 def _process_node_permissions(**kwargs):
     """
     This function checks and associates the three permissions (reply, edit, delete) to each comment node. This allows permission based access on a per comment basis.
@@ -76,10 +127,20 @@ def _process_node_permissions(**kwargs):
     request = kwargs.get('request', None)
     parent_object = kwargs.get('parent_object', None)
     max_depth = kwargs.get('max_depth', None)
+    # Permissions that aren't functions on the parent_object can't vary by comment, so they are only evaluated once for the whole tree
+    static_permissions = {}
+    for permission_function in ('can_reply_to_comment', 'can_post_comment', 'can_delete_comment'):
+        if not callable(getattr(parent_object, permission_function, None)):
+            static_permissions[permission_function] = user_has_permission(request, parent_object, permission_function)
     for comment in kwargs.get('nodes', []):
-        comment.can_reply = user_has_permission(request, parent_object, 'can_reply_to_comment', comment=comment) and (comment.level < max_depth)
-        comment.can_edit = user_has_permission(request, parent_object, 'can_post_comment', comment=comment)
-        comment.can_delete = user_has_permission(request, parent_object, 'can_delete_comment', comment=comment)
+        comment.can_reply = _get_node_permission(request, parent_object, 'can_reply_to_comment', comment, static_permissions) and (comment.level < max_depth)
+        comment.can_edit = _get_node_permission(request, parent_object, 'can_post_comment', comment, static_permissions)
+        comment.can_delete = _get_node_permission(request, parent_object, 'can_delete_comment', comment, static_permissions)
+
+def _get_node_permission(request, parent_object, permission_function, comment, static_permissions):
+    if permission_function in static_permissions:
+        return static_permissions[permission_function]
+    return user_has_permission(request, parent_object, permission_function, comment=comment)
 
 
 def get_attr_val(request, obj, attr, default=None, **kwargs):
@@ -99,6 +160,74 @@ def get_attr_val(request, obj, attr, default=None, **kwargs):
 def user_has_permission(request, parent_object, permission_function, **kwargs):
     """
         Helper method that defaults all permission checks to "is_authenticated" if it is not defined on the parent_object.
+        Checks that aren't tied to a comment (no kwargs) are cached on the request, since they will give the same answer for the rest of it.
+    """
+    if kwargs:
+        return get_attr_val(request, parent_object, permission_function, request.user.is_authenticated, **kwargs)
+
+    permission_cache = request.__dict__.setdefault('_comment_permission_cache', {})
+    cache_key = (id(parent_object), permission_function)
+    if cache_key not in permission_cache:
+        permission_cache[cache_key] = get_attr_val(request, parent_object, permission_function, request.user.is_authenticated)
+    return permission_cache[cache_key]
+
+def _get_tree_cache_timeout():
+    """
+    The number of seconds a rendered comment tree is cached for. The cache is opt in, a falsy value (the default) disables it.
+    """
+    return settings.COMMENTS_CACHE_TIMEOUT if hasattr(settings, 'COMMENTS_CACHE_TIMEOUT') else 0
+
+def _get_tree_cache_version(tree_id):
+    """
+    Returns the current version counter for a comment tree. The counter is part of every cache key for that tree, so bumping it invalidates them all.
+    """
+    key = 'comments:tree-version:%s' % tree_id
+    version = cache.get(key)
+    if version is None:
+        # The counter is seeded with the current time (instead of 0) so an evicted counter can't come back with a value that stale fragments are still cached under.
+        version = int(time.time() * 1000)
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+def bump_tree_cache_version(tree_id):
+    """
+    Invalidates every cached rendering of the given comment tree.
+    """
+    try:
+        cache.incr('comments:tree-version:%s' % tree_id)
+    except ValueError:
+        # The counter doesn't exist (yet or anymore), seeding a new one is enough to invalidate the old keys.
+        _get_tree_cache_version(tree_id)
+
+def _get_tree_cache_key(request, tree_root, comments_template):
+    """
+    Builds the cache key for a rendered comment tree. Permissions are evaluated per user, the 'X_KWARGS' header is passed through to the templates
+    and the parent_object can pick the template per request, so all of them are part of the key.
+    """
+    variant = '%s|%s' % (request.META.get('HTTP_X_KWARGS', ''), comments_template)
+    variant_hash = hashlib.md5(variant.encode('utf-8')).hexdigest()
+    return 'comments:rendered-tree:%s:%s:%s:%s' % (tree_root.tree_id, _get_tree_cache_version(tree_root.tree_id), request.user.pk, variant_hash)
+
+@receiver(setting_changed)
+def _clear_template_cache(setting, **kwargs):
+    # Changing the template settings (ex. override_settings in tests) replaces the template engines, so the templates they compiled can't be reused
+    if setting in ('TEMPLATES', 'DEBUG'):
+        _load_template.cache_clear()
+
+@lru_cache(maxsize=32)
+def _load_template(template_name):
+    if isinstance(template_name, tuple):
+        return loader.select_template(template_name)
+    return loader.get_template(template_name)
+
+def _get_compiled_template(template_name):
+    """
+    Returns the compiled template object for 'template_name' (a name or a list of names, like render_to_string accepts).
+    Templates are only looked up once per process, except when DEBUG is on so changes to them are still picked up.
     """
-    default = request.user.is_authenticated
-    return get_attr_val(request, parent_object, permission_function, default, **kwargs)
+    if isinstance(template_name, list):
+        template_name = tuple(template_name)
+    if settings.DEBUG:
+        _load_template.cache_clear()
+    return _load_template(template_name)
@@ -1,20 +1,21 @@
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.db import transaction
-from django.db.models.query import Prefetch
-from django.http import JsonResponse
+from django.db.models.query import Prefetch, prefetch_related_objects
 from django.http.response import Http404
 from django.shortcuts import render
-from django.template import loader
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET
 
 from .forms import CommentVersionForm
 from .models import Comment, CommentVersion
+from .responses import OrjsonResponse, StreamingJsonResponse
 from .signals import comment_changed
-from .utils import InvalidCommentException, _get_target_comment, _get_or_create_tree_root, _process_node_permissions, user_has_permission, get_attr_val
+from .utils import InvalidCommentException, _get_target_comment, _get_or_create_tree_root, _process_node_permissions, user_has_permission, get_attr_val, \
+                   bump_tree_cache_version, _get_tree_cache_key, _get_tree_cache_timeout, _get_compiled_template, _get_parent_object, _request_kwargs, get_cached_root
 
-import json
+_STALE_VERSION_MESSAGE = "You are not editing the most recent version of this comment. Please refresh your page and try again."
 
 def create_comment_without_request(obj, user, message):
     """
@@ -42,14 +43,25 @@ def create_new_version_without_request(comment, message, user):
     """
     return new_version(comment, user, {'message':message, 'comment':comment, 'posting_user':user})
 
-def new_version(comment, user, form_data_to_bind):
+def new_version(comment, user, form_data_to_bind, previous_version=None):
+    """
+    Saves a new version of 'comment' and makes it the comment's current_version. 'previous_version' is the version being edited (None if the comment is new, or
+    if the version is simply being added, ex. create_new_version_without_request). An InvalidCommentException is raised (and nothing is saved) if it isn't the most recent version anymore.
+    """
     version_form = CommentVersionForm(form_data_to_bind)
     new_version = None
     if version_form.is_valid():
-        new_version = version_form.save(commit=False)
-        new_version.comment = comment
-        new_version.posting_user = user
-        new_version.save()
+        # The version and the comment's current_version are saved together, if the version check fails neither is
+        with transaction.atomic(savepoint=False):
+            new_version = version_form.save(commit=False)
+            new_version.comment = comment
+            new_version.posting_user = user
+            new_version.save()
+            if not _claim_current_version(comment, previous_version, new_version):
+                raise InvalidCommentException(_STALE_VERSION_MESSAGE)
+        comment.latest_version = new_version
+        # Any cached rendering of this tree is now out of date (bumped on commit so a concurrent load can't re-cache the old tree)
+        transaction.on_commit(lambda: bump_tree_cache_version(comment.tree_id))
 
     return version_form, new_version
     
@@ -58,54 +70,89 @@ def get_comment(request):
     comment, previous_version = _get_target_comment(request)
     return comment, previous_version
 
-def user_can_post_comment(request, comment):
-    parent_comment = comment.parent
-    tree_root = parent_comment.get_root()
-    parent_object = tree_root.content_object
+def user_can_post_comment(request, comment, parent_object):
     return user_has_permission(request, parent_object, 'can_post_comment', comment=comment)
 
-def is_past_max_depth(comment):
-    parent_comment = comment.parent
-    tree_root = parent_comment.get_root()
-
+def is_past_max_depth(parent_comment, tree_root):
     return parent_comment.level >= tree_root.max_depth
 
 def add_comment(comment):
     # TODO: Add the ability to override "position" (default is 'last-child')
     parent_comment = comment.parent
 
-    # We lock the parent comment to prevent a race condition when adding new comments
-    lock_comment(parent_comment, False)
+    # We lock the parent comment to prevent a race condition when adding new comments.
+    # The locked row is read after any other insert into this tree has committed, so its lft/rght are current and mptt doesn't need to refresh them with another SELECT.
+    parent_comment = Comment.objects.select_for_update().get(pk=parent_comment.pk)
 
-    return Comment.objects.insert_node(comment, parent_comment, save=True)
+    # As a 'last-child' the new comment goes right before the parent's rght, so mptt only has to shift the nodes after that point (one UPDATE) before the INSERT
+    return Comment.objects.insert_node(comment, parent_comment, position='last-child', save=True, refresh_target=False)
 
-def lock_comment(comment, nowait=True):
-    Comment.objects.select_for_update(nowait=nowait).get(pk=comment.pk)
+def _claim_current_version(comment, previous_version, new_version):
+    """
+    Makes 'new_version' the comment's current_version. For an edit this only happens if 'previous_version' (the one the user was editing) still is the most recent version.
+    The conditional UPDATE holds the comment's row lock until the transaction ends, so two edits of the same version can't both succeed.
+    Returns False (and leaves current_version alone) if 'previous_version' is no longer the most recent version.
+    """
+    if not previous_version:
+        Comment.objects.filter(pk=comment.pk).update(current_version=new_version)
+        return True
+    if Comment.objects.filter(pk=comment.pk, current_version=previous_version).update(current_version=new_version):
+        return True
+
+    # current_version is NULL or stale for comments whose versions were saved before it existed (or without going through new_version),
+    # so we lock the row and compare against the versions themselves, repairing current_version if the edit is of the most recent one
+    Comment.objects.select_for_update().get(pk=comment.pk)
+    if comment.versions.exclude(pk=new_version.pk).latest() != previous_version:
+        return False
+    Comment.objects.filter(pk=comment.pk).update(current_version=new_version)
+    return True
+
+def _check_most_recent_version(previous_version):
+    """
+    Raises an InvalidCommentException if 'previous_version' (as fetched by _get_target_comment) is already known not to be the most recent version, so a stale edit is turned away before anything is written.
+    """
+    if previous_version and previous_version.latest_version_id != previous_version.pk:
+        raise InvalidCommentException(_STALE_VERSION_MESSAGE)
 
-def not_most_recent_version(comment, previous_version):
-    return previous_version and previous_version != comment.versions.latest()
+def create_new_version(request, comment, previous_version=None):
+    return new_version(comment, request.user, request.POST, previous_version)
 
-def create_new_version(request, comment):
-    return new_version(comment, request.user, request.POST)
+def send_comment_changed(comment, request, version_saved, comment_action, kwargs):
+    """
+    Sends the comment_changed signal after the current transaction commits, so receivers doing slow work don't extend the transaction (or hold the comment's row lock)
+    and never hear about a change that was rolled back.
+    """
+    # The kwargs are copied since the view keeps adding to them (for the template) before the signal goes out
+    kwargs = dict(kwargs)
+    transaction.on_commit(lambda: comment_changed.send(sender=comment.__class__, comment=comment, request=request, version_saved=version_saved, comment_action=comment_action, kwargs=kwargs))
 
 def get_template(request, comment, parent_object, tree_root, new_version, previous_version, send_signal=True):
-    # The 'X_KWARGS' header is populated by settings.kwarg in comments.js
-    kwargs = json.loads(request.META.get('HTTP_X_KWARGS', {}))
+    kwargs = _request_kwargs(request)
+
+    # The templates count the comment's versions several times, so the versions cache is filled here (the same way load_comments' prefetch does) instead of each count querying
+    if previous_version:
+        prefetch_related_objects([comment], Prefetch('versions', queryset=CommentVersion.objects.order_by('-date_posted')))
+    else:
+        # A new comment's only version is the one that was just saved, so there is nothing to fetch
+        versions = CommentVersion.objects.filter(comment=comment)
+        versions._result_cache = [new_version]
+        versions._prefetch_done = True
+        comment._prefetched_objects_cache = {'versions': versions}
 
     kwargs.update({
                    'node': comment,
                    'nodes': [comment], # We need both because of _process_node_permissions and the fact that 'post' requires the full comments template
-                   'latest_version': comment.versions.latest(), # We need this here because the latest version is not available inside the single comment template (used for edit)
+                   'latest_version': comment.latest_version, # We need this here because the latest version is not available inside the single comment template (used for edit)
                    'parent_object': parent_object,
                    'max_depth': tree_root.max_depth
                    })
 
-    # Now that the version has been saved, we fire off the appropriate signal before returning the rendered template
+    # Now that the version has been saved, we queue up the appropriate signal (it's sent once the transaction commits)
     if previous_version:
-        if send_signal: comment_changed.send(sender=comment.__class__, comment=comment, request=request, version_saved=new_version, comment_action='edit', kwargs=kwargs)
+        if send_signal: send_comment_changed(comment, request, new_version, 'edit', kwargs)
         comment_template = get_attr_val(request, parent_object, 'single_comment_template', 'comments/comments.html', **kwargs)
     else:
-        if send_signal: comment_changed.send(sender=comment.__class__, comment=comment, request=request, version_saved=new_version, comment_action='post', kwargs=kwargs)
+        if send_signal: send_comment_changed(comment, request, new_version, 'post', kwargs)
         comment_template = get_attr_val(request, parent_object, 'comments_template', 'comments/comments.html', **kwargs)
 
     kwargs['request'] = request
@@ -124,20 +171,22 @@ def post_comment_form(request):
         raise
 
     parent_comment = comment.parent
-    tree_root = parent_comment.get_root()
-    parent_object = tree_root.content_object
-    if not user_can_post_comment(request, comment):
+    tree_root = get_cached_root(parent_comment)
+    parent_object = _get_parent_object(request, tree_root)
+    if not user_can_post_comment(request, comment, parent_object):
         raise Exception("User can't create comments")
 
-    if is_past_max_depth(comment):
+    if is_past_max_depth(parent_comment, tree_root):
         raise Exception("Max depth reached")
 
+    _check_most_recent_version(previous_version)
+
     # If the comment object (NOT the message) hasn't been saved yet...
     if comment._state.adding == True:
        comment = add_comment(comment)
 
     # Everything has checked out, so we save the new version and return the appropriate response
-    version_form, new_version = create_new_version(request, comment)
+    version_form, new_version = create_new_version(request, comment, previous_version)
 
     return comment
 
@@ -151,8 +200,8 @@ def post_comment(request, send_signal=True):
     try:
         comment, previous_version = get_comment(request)
     except InvalidCommentException as e:
-        transaction.rollback()
-        return JsonResponse({
+        transaction.set_rollback(True)
+        return OrjsonResponse({
             'ok': False,
             'error_message': str(e),
         })
@@ -160,20 +209,21 @@ def post_comment(request, send_signal=True):
     # Check if the user doesn't pass the appropriate permission check (on the parent_object)...
     # We call this on the parent comment because the comment itself may not have been saved yet (can't call .get_root on it)
     # TODO: Fix this for root comment? (no parent)
+    # The root and its parent_object are resolved once here and passed along to every check below.
     parent_comment = comment.parent
-    tree_root = parent_comment.get_root()
-    parent_object = tree_root.content_object
-    if not user_can_post_comment(request, comment):
+    tree_root = get_cached_root(parent_comment)
+    parent_object = _get_parent_object(request, tree_root)
+    if not user_can_post_comment(request, comment, parent_object):
         transaction.set_rollback(True)
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
             'error_message': "You do not have permission to post this comment.",
         })
 
     # Check to make sure we are not trying to save a comment "deeper" than we are allowed...
-    if is_past_max_depth(comment):
+    if is_past_max_depth(parent_comment, tree_root):
         transaction.set_rollback(True)
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
             'error_message': "You cannot respond to this comment.",
         })
@@ -182,40 +232,30 @@ def post_comment(request, send_signal=True):
     if comment._state.adding == True:
        comment = add_comment(comment)
 
-    # Now that we have a comment object, we get a 'lock' on it to prevent a race condition
+    # Everything has checked out, so we save the new version. Both steps fail if the user isn't editing the most recent version:
+    # the first with what was already fetched, the second if someone else saved a version of this comment in the meantime.
     try:
-        lock_comment(comment)
-    except DatabaseError:
+        _check_most_recent_version(previous_version)
+        version_form, new_version = create_new_version(request, comment, previous_version)
+    except InvalidCommentException as e:
         transaction.set_rollback(True)
-        # Someone is already trying to update this comment, so we need to return an appropriate error
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
-            'error_message': "Someone else is currently editing this comment. Please refresh your page and try again.",
+            'error_message': str(e),
         })
-
-    # Now we know we have sole access to the comment object at the moment so we need to check if we are editing the most recent version
-    if not_most_recent_version(comment, previous_version):
+    if not version_form.is_valid():
         transaction.set_rollback(True)
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
-            'error_message': "You are not editing the most recent version of this comment. Please refresh your page and try again.",
+            'error_message': "There were errors in your submission. Please correct them and resubmit.",
         })
 
-    # Everything has checked out, so we save the new version and return the appropriate response
-    version_form, new_version = create_new_version(request, comment)
-    if version_form.is_valid():
-        comment_template, kwargs = get_template(request, comment, parent_object, tree_root, new_version, previous_version, send_signal=send_signal)
+    comment_template, kwargs = get_template(request, comment, parent_object, tree_root, new_version, previous_version, send_signal=send_signal)
 
-        return JsonResponse({
-            'ok': True,
-            'html_content': loader.render_to_string(comment_template, context=kwargs)
-        })
-    else:
-        transaction.set_rollback(True)
-        return JsonResponse({
-            'ok': False,
-            'error_message': "There were errors in your submission. Please correct them and resubmit.",
-        })
+    return OrjsonResponse({
+        'ok': True,
+        'html_content': _get_compiled_template(comment_template).render(kwargs)
+    })
 
 @transaction.atomic
 @require_POST
@@ -225,7 +265,7 @@ def delete_comment(request):
         comment, previous_version = _get_target_comment(request)
     except InvalidCommentException as e:
         transaction.set_rollback(True)
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
             'error_message': str(e),
         })
@@ -234,38 +274,39 @@ def delete_comment(request):
     # We call this on the parent comment because the comment itself may not have been saved yet (can't call .get_root on it)
     # TODO: Fix this for root comment? (no parent)
     parent_comment = comment.parent
-    tree_root = parent_comment.get_root()
-    parent_object = tree_root.content_object
+    tree_root = get_cached_root(parent_comment)
+    parent_object = _get_parent_object(request, tree_root)
     if not user_has_permission(request, parent_object, 'can_delete_comment', comment=comment):
         transaction.set_rollback(True)
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
             'error_message': "You do not have permission to post this comment.",
         })
 
     try:
-        # The 'X_KWARGS' header is populated by settings.kwarg in comments.js
-        kwargs = json.loads(request.META.get('HTTP_X_KWARGS', {}))
+        kwargs = _request_kwargs(request)
         comment_changed.send(sender=comment.__class__, comment=comment, request=request, version_saved=None, comment_action='pre_delete', kwargs=kwargs)
 
+        # The comment is re-read under a row lock so its lft/rght are current (a reply inserted since it was loaded shifts them),
+        # then it and everything under it is flagged in a single UPDATE instead of saving each child
+        comment = Comment.objects.select_for_update().get(pk=comment.pk)
+        comment.get_descendants(include_self=True).update(deleted=True)
         comment.deleted = True
-        comment.save()
-        for child in comment.get_children():
-            child.deleted = True
-            child.save()
+        transaction.on_commit(lambda: bump_tree_cache_version(comment.tree_id))
+        # 'pre_delete' is still sent synchronously above (receivers can abort the delete), 'post_delete' waits for the commit like the other actions
+        send_comment_changed(comment, request, None, 'post_delete', kwargs)
 
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': True,
         })
     except Exception as e:
         # TODO: Handle this more eloquently? Log? Probably best not to pass back raw error.
         transaction.set_rollback(True)
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
             'error_message': 'There was an error deleting the selected comment(s).',
         })
 
-@transaction.atomic
 @require_GET
 def load_comments(request):
     """
@@ -274,28 +315,34 @@ def load_comments(request):
     """
     # TODO: Add the ability to return comment tree in JSON format.
     # First we get the root of the comment tree being requested
+    # Creating the root is the only write this view can do, so it's also the only part that runs in a transaction (required by the lock that serializes root creation)
     try:
-        tree_root, parent_object = _get_or_create_tree_root(request)
+        with transaction.atomic():
+            tree_root, parent_object = _get_or_create_tree_root(request)
     except InvalidCommentException as e:
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
             'error_message': str(e),
         })
 
     # Check if the user doesn't pass the appropriate permission check (on the parent_object)...
     if not user_has_permission(request, parent_object, 'can_view_comments'):
-        return JsonResponse({
+        return OrjsonResponse({
             'ok': False,
             'error_message': "You do not have permission to view comments for this object.",
         })
 
     # Once we have our desired nodes, we tack on all of the select/prefetch related stuff
-    nodes = tree_root.get_family().select_related('deleted_user_info', 'created_by', 'parent', 'content_type')\
-                                  .prefetch_related(Prefetch('versions', queryset=CommentVersion.objects.order_by('-date_posted')\
-                                                                                                        .select_related('posting_user', 'deleted_user_info')))
-
-    # The 'X_KWARGS' header is populated by settings.kwarg in comments.js
-    kwargs = json.loads(request.META.get('HTTP_X_KWARGS', {}))
+    # tree_root is always a root node, so its family is the whole tree: a single scan of mptt's (tree_id, lft) index rather than get_family's ancestor/descendant OR,
+    # and no lft/rght bounds that go stale when the (possibly cached) root's rght moves
+    # Only the root has a content_type (and it's already loaded), and the parent's 'data' would be repeated on every one of its children's rows, so neither is fetched
+    nodes = Comment.objects.filter(tree_id=tree_root.tree_id)\
+                           .select_related('deleted_user_info', 'created_by', 'parent')\
+                           .defer('parent__data')\
+                           .prefetch_related(Prefetch('versions', queryset=CommentVersion.objects.order_by('-date_posted')\
+                                                                                                 .select_related('posting_user', 'deleted_user_info')))
+
+    kwargs = _request_kwargs(request)
     kwargs.update({
                    'nodes': nodes,
                    'parent_object': parent_object,
@@ -304,16 +351,41 @@ def load_comments(request):
 
     comments_template = get_attr_val(request, parent_object, 'comments_template', 'comments/comments.html', **kwargs)
 
+    # The rendered tree is cached until a comment in it changes (or the timeout passes, since permissions are evaluated on the parent_object)
+    cache_timeout = _get_tree_cache_timeout()
+    if cache_timeout:
+        html_content, number_of_comments = cache.get_or_set(_get_tree_cache_key(request, tree_root, comments_template),
+                                                            lambda: _render_comment_tree(request, parent_object, comments_template, nodes, kwargs),
+                                                            cache_timeout)
+    else:
+        html_content, number_of_comments = _render_comment_tree(request, parent_object, comments_template, nodes, kwargs)
+
+    # The tree can be large, so it is streamed out instead of being copied again into a fully encoded JSON document
+    return StreamingJsonResponse({
+        'ok': True,
+        'html_content': html_content,
+        'number_of_comments': number_of_comments
+    })
+
+def _render_comment_tree(request, parent_object, comments_template, nodes, kwargs):
+    """
+    Returns the rendered comment tree and the number of comments in it (not counting the root or deleted comments).
+    """
     # In the parent_object, sites can define a function called 'filter_nodes' if they wish to apply any additional filtering to the nodes queryset before it's rendered to the template.
     # Default value is the nodes tree with the deleted comments filtered out.
     nodes = get_attr_val(request, parent_object, "filter_nodes", default=nodes.filter(deleted=False), **kwargs)
     kwargs.update({"nodes": nodes, 'request': request})
 
+    # The versions prefetch is ordered by '-date_posted', so the first one is the latest. Storing it here saves a query per node when the template asks for it.
+    # The nodes are counted in the same pass, since they are already in memory.
+    number_of_comments = 0
+    for node in nodes:
+        versions = node.versions.all()
+        node.latest_version = versions[0] if versions else None
+        if node.parent_id and not node.deleted:
+            number_of_comments += 1
+
     # Checks/assigns permissions to each node (so the template doesn't have to)
     _process_node_permissions(**kwargs)
 
-    return JsonResponse({
-        'ok': True,
-        'html_content': loader.render_to_string(comments_template, context=kwargs, request=request),
-        'number_of_comments': tree_root.get_descendant_count()
-    })
\ No newline at end of file
+    return _get_compiled_template(comments_template).render(kwargs, request), number_of_comments
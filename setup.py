@@ -15,6 +15,9 @@ setup(
         'django-mptt',
         'bleach',
     ],
+    extras_require={
+        'orjson': ['orjson'],
+    },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',